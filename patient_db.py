@@ -1,10 +1,41 @@
+from contextlib import contextmanager
+
+import orjson
 import psycopg
-from psycopg.rows import dict_row
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row, tuple_row
+from psycopg.types.json import Jsonb, set_json_dumps
+from psycopg_pool import ConnectionPool, PoolTimeout
 import json
+import logging
 from datetime import datetime
 import os
 import time
 
+logger = logging.getLogger(__name__)
+
+def _json_dumps(obj, option=0):
+    """
+    Encodes obj with orjson, accepting non-string dict keys as json.dumps
+    does. Falls back to json.dumps for integers wider than 64 bits, which
+    orjson cannot encode. NaN and Infinity are written as null, where
+    PostgreSQL used to reject the NaN/Infinity tokens json.dumps emitted.
+    """
+    try:
+        return orjson.dumps(obj, option=option | orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        indent = 2 if option & orjson.OPT_INDENT_2 else None
+        return json.dumps(obj, indent=indent).encode()
+
+
+class ConcurrencyConflict(Exception):
+    """
+    Raised when a patient row was modified by another writer after the
+    version the caller expected was read.
+    """
+
+
 class PatientDatabase:
     """
     A class to manage a PostgreSQL database for storing and updating
@@ -13,277 +44,609 @@ class PatientDatabase:
 
     def __init__(self, db_params, history_limit=10):
         """
-        Initializes the database connection and sets the history limit.
+        Initializes the database connection pool and sets the history limit.
 
         Args:
             db_params (dict): A dictionary of connection parameters for PostgreSQL.
             history_limit (int, optional): The maximum number of plan snapshots
                                            to store per patient. Defaults to 10.
+                                           Must be at least 1.
         """
-        self.conninfo = " ".join([f"{k}={v}" for k, v in db_params.items()])
-        self.conn = None
+        if history_limit < 1:
+            raise ValueError("history_limit must be at least 1.")
+
+        # TCP keepalives and timeouts keep idle pooled connections from being
+        # silently dropped; any of them can be overridden through db_params.
+        conn_options = {
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "tcp_user_timeout": 10000,
+            "connect_timeout": 5
+        }
+        conn_options.update(db_params)
+        self.conninfo = make_conninfo(**conn_options)
         self.history_limit = history_limit
+        self.pool = ConnectionPool(
+            self.conninfo,
+            min_size=2,
+            max_size=10,
+            # Statements are reused verbatim on every call, so prepare them server-side
+            # from their first execution.
+            kwargs={"row_factory": dict_row, "prepare_threshold": 0},
+            configure=self._configure_connection,
+            open=True
+        )
         try:
-            self.conn = psycopg.connect(self.conninfo, row_factory=dict_row)
-        except psycopg.OperationalError as e:
-            print(f"Could not connect to the PostgreSQL database: {e}")
+            # Fail after one connect_timeout instead of the pool's default 30s of retries
+            self.pool.wait(timeout=float(conn_options["connect_timeout"]))
+        except PoolTimeout as e:
+            self.pool.close()
+            logger.error("Could not connect to the PostgreSQL database: %s", e)
             raise
 
-    def _execute_query(self, query, params=None, fetch=None):
-        """Helper function to execute queries."""
-        with self.conn.cursor() as cursor:
-            cursor.execute(query, params or ())
-            if fetch == 'one':
-                return cursor.fetchone()
-            if fetch == 'all':
-                return cursor.fetchall()
-            self.conn.commit()
+    @staticmethod
+    def _configure_connection(conn):
+        """
+        Pins the session time zone to UTC and encodes JSON/JSONB parameters
+        with orjson on every pooled connection.
+        """
+        set_json_dumps(_json_dumps, conn)
+        # Naive 'Time of most recent update' values are then stored as UTC and
+        # read back with a +00:00 offset, whatever the server's default zone is
+        conn.execute("SET TIME ZONE 'UTC'")
+        conn.commit()
+
+    @contextmanager
+    def _transaction(self, row_factory=None):
+        """
+        Yields a cursor on a single pooled connection. Everything executed on
+        it is committed together, or rolled back if the block raises.
+        """
+        with self.pool.connection() as conn, conn.transaction(), conn.cursor(row_factory=row_factory) as cursor:
+            yield cursor
+
+    def _execute_query(self, query, params=None, fetch=None, row_factory=None, cursor=None):
+        """
+        Helper function to execute queries on a pooled connection. The
+        transaction is committed when the connection is returned to the pool.
+        Rows are returned as dicts unless another row_factory is given.
+        Pass a cursor from _transaction() to run the query as part of that
+        transaction instead; it is then committed with the rest of the block.
+        """
+        if cursor is None:
+            with self.pool.connection() as conn, conn.cursor(row_factory=row_factory) as pooled_cursor:
+                return self._execute_query(query, params, fetch, cursor=pooled_cursor)
+
+        cursor.execute(query, params or ())
+        if fetch == 'one':
+            return cursor.fetchone()
+        if fetch == 'all':
+            return cursor.fetchall()
 
     def create_tables(self):
-        self._execute_query("""
-            CREATE TABLE IF NOT EXISTS patients (
-                patient_id SERIAL PRIMARY KEY,
-                patient_name TEXT UNIQUE NOT NULL,
-                procedure TEXT,
-                last_updated TEXT,
-                soft_data TEXT,
-                current_plan JSONB
-            );
-        """)
-        self._execute_query("""
-            CREATE TABLE IF NOT EXISTS plan_history (
-                history_id SERIAL PRIMARY KEY,
-                patient_name TEXT NOT NULL REFERENCES patients(patient_name) ON DELETE CASCADE,
-                plan_snapshot JSONB NOT NULL
-            );
-        """)
-        self._execute_query("""
-            CREATE TABLE IF NOT EXISTS dhp_history (
-                history_id SERIAL PRIMARY KEY,
-                patient_name TEXT NOT NULL REFERENCES patients(patient_name) ON DELETE CASCADE,
-                procedure TEXT,
-                last_updated TEXT,
-                soft_data TEXT
-            );
-        """)
-        print("Tables for DHP and plan snapshot history created or already exist.")
-
-    def push_dhp(self, dhp_data):
-        data = dhp_data
-        hard_data = data.get("hard", {})
+        with self._transaction(row_factory=tuple_row) as cursor:
+            self._execute_query("""
+                CREATE TABLE IF NOT EXISTS patients (
+                    patient_id SERIAL PRIMARY KEY,
+                    patient_name TEXT UNIQUE NOT NULL,
+                    procedure TEXT,
+                    last_updated TIMESTAMPTZ,
+                    soft_data JSONB,
+                    current_plan JSONB,
+                    version INT NOT NULL DEFAULT 0
+                );
+            """, cursor=cursor)
+            # Tables created before optimistic locking have no version column
+            self._execute_query("""
+                ALTER TABLE patients ADD COLUMN IF NOT EXISTS version INT NOT NULL DEFAULT 0;
+            """, cursor=cursor)
+            self._execute_query("""
+                CREATE TABLE IF NOT EXISTS plan_history (
+                    history_id BIGSERIAL PRIMARY KEY,
+                    patient_id INT NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+                    plan_snapshot JSONB NOT NULL
+                );
+            """, cursor=cursor)
+            self._execute_query("""
+                CREATE TABLE IF NOT EXISTS dhp_history (
+                    history_id BIGSERIAL PRIMARY KEY,
+                    patient_id INT NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+                    procedure TEXT,
+                    last_updated TIMESTAMPTZ,
+                    soft_data JSONB
+                );
+            """, cursor=cursor)
+            for table in ("plan_history", "dhp_history"):
+                self._migrate_history_to_patient_id(cursor, table)
+            self._execute_query("""
+                CREATE INDEX IF NOT EXISTS plan_history_patient_id_desc
+                ON plan_history (patient_id, history_id DESC);
+            """, cursor=cursor)
+            self._execute_query("""
+                CREATE INDEX IF NOT EXISTS dhp_history_patient_id_desc
+                ON dhp_history (patient_id, history_id DESC);
+            """, cursor=cursor)
+            for table in ("patients", "dhp_history"):
+                self._migrate_last_updated(cursor, table)
+                self._migrate_soft_data(cursor, table)
+            for table in ("plan_history", "dhp_history"):
+                self._migrate_history_id(cursor, table)
+        logger.debug("Tables for DHP and plan snapshot history created or already exist.")
+
+    def _column_type(self, cursor, table, column):
+        """Returns the information_schema data_type of a column, or None if it does not exist."""
+        column_type = self._execute_query("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s;
+        """, (table, column), fetch='one', cursor=cursor)
+        return column_type[0] if column_type else None
+
+    def _migrate_last_updated(self, cursor, table):
+        """
+        Converts a last_updated column created as TEXT to TIMESTAMPTZ. The
+        column used to hold 'Time of most recent update' verbatim, so values
+        that are empty or not an ISO 8601 timestamp become NULL instead of
+        failing the conversion.
+        """
+        if self._column_type(cursor, table, "last_updated") != "text":
+            return
+
+        iso_timestamp = (
+            "^[1-9][0-9]{3}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01])"
+            "([T ]([01][0-9]|2[0-3]):[0-5][0-9](:[0-5][0-9]([.][0-9]+)?)?"
+            "([Zz]|[+-](0[0-9]|1[0-4])(:?[0-5][0-9])?)?)?$"
+        )
+        # The pattern accepts day 31 in every month, so the day is checked
+        # against the month's length before casting
+        self._execute_query(sql.SQL("""
+            ALTER TABLE {table} ALTER COLUMN last_updated TYPE TIMESTAMPTZ USING
+            CASE WHEN last_updated ~ {iso_timestamp} THEN
+                CASE WHEN substr(last_updated, 9, 2)::int
+                          <= extract(day from (left(last_updated, 7) || '-01')::date + interval '1 month - 1 day')
+                     THEN last_updated::timestamptz
+                END
+            END;
+        """).format(table=sql.Identifier(table), iso_timestamp=sql.Literal(iso_timestamp)), cursor=cursor)
+        logger.debug("Converted %s.last_updated to TIMESTAMPTZ.", table)
+
+    def _migrate_soft_data(self, cursor, table):
+        """
+        Converts a soft_data column created as TEXT to JSONB. Only strings
+        could be bound to it, so each value is kept as a JSON string.
+        """
+        if self._column_type(cursor, table, "soft_data") != "text":
+            return
+
+        self._execute_query(sql.SQL(
+            "ALTER TABLE {} ALTER COLUMN soft_data TYPE JSONB USING to_jsonb(soft_data);"
+        ).format(sql.Identifier(table)), cursor=cursor)
+        logger.debug("Converted %s.soft_data to JSONB.", table)
+
+    def _migrate_history_id(self, cursor, table):
+        """Widens a history_id column created as SERIAL, and its sequence, to BIGINT."""
+        if self._column_type(cursor, table, "history_id") != "integer":
+            return
+
+        self._execute_query(sql.SQL("ALTER SEQUENCE {} AS BIGINT;").format(
+            sql.Identifier(f"{table}_history_id_seq")
+        ), cursor=cursor)
+        self._execute_query(sql.SQL("ALTER TABLE {} ALTER COLUMN history_id TYPE BIGINT;").format(
+            sql.Identifier(table)
+        ), cursor=cursor)
+        logger.debug("Widened %s.history_id to BIGINT.", table)
+
+    def _migrate_history_to_patient_id(self, cursor, table):
+        """
+        Re-keys a history table created with a patient_name column onto
+        patient_id. The foreign key on patient_name guarantees every row has
+        a patients row to take its id from.
+        """
+        if self._column_type(cursor, table, "patient_name") is None:
+            return
+
+        identifier = sql.Identifier(table)
+        self._execute_query(sql.SQL(
+            "ALTER TABLE {} ADD COLUMN IF NOT EXISTS patient_id INT REFERENCES patients(patient_id) ON DELETE CASCADE;"
+        ).format(identifier), cursor=cursor)
+        self._execute_query(sql.SQL(
+            "UPDATE {} h SET patient_id = p.patient_id FROM patients p "
+            "WHERE p.patient_name = h.patient_name AND h.patient_id IS NULL;"
+        ).format(identifier), cursor=cursor)
+        self._execute_query(sql.SQL(
+            "ALTER TABLE {} ALTER COLUMN patient_id SET NOT NULL;"
+        ).format(identifier), cursor=cursor)
+        # Also drops the old foreign key and the (patient_name, history_id DESC) index
+        self._execute_query(sql.SQL(
+            "ALTER TABLE {} DROP COLUMN patient_name;"
+        ).format(identifier), cursor=cursor)
+        logger.debug("Migrated history table %s from patient_name to patient_id.", table)
+
+    @staticmethod
+    def _parse_timestamp(value):
+        """Converts an ISO 8601 'Time of most recent update' string to a datetime for binding."""
+        if isinstance(value, str):
+            if not value:
+                return None
+            try:
+                return datetime.fromisoformat(value)
+            except ValueError:
+                raise ValueError(
+                    f"DHP 'Time of most recent update' must be an ISO 8601 timestamp, got {value!r}."
+                ) from None
+        return value
+
+    def _dhp_params(self, dhp_data):
+        """Maps a DHP document onto the named query parameters used by the push methods."""
+        hard_data = dhp_data.get("hard", {})
         patient_name = hard_data.get("Patient Alias")
 
         if not patient_name:
             raise ValueError("DHP data must contain a 'Patient Alias'.")
 
-        params = {
+        return {
             'alias': patient_name,
             'proc': hard_data.get("Patient's Procedure Performed or Non-Surgical Pathology"),
-            'updated': hard_data.get("Time of most recent update"),
-            'soft': data.get("soft", "")
+            'updated': self._parse_timestamp(hard_data.get("Time of most recent update")),
+            'soft': Jsonb(dhp_data.get("soft", {}))
         }
 
-        # Insert or update the main patients table
-        update_query = """
+    def push_dhp(self, dhp_data, expected_version=None):
+        params = self._dhp_params(dhp_data)
+        patient_name = params['alias']
+
+        # Upsert the patients row, record the snapshot in history and trim the
+        # history in a single statement. All CTEs see the same snapshot, so the
+        # trim cannot see the row being inserted and keeps history_limit - 1
+        # of the existing rows. While the patient has fewer rows than that,
+        # cutoff is empty and the DELETE never scans dhp_history.
+        push_query = """
+            WITH ins AS (
+                INSERT INTO patients (patient_name, procedure, last_updated, soft_data, current_plan)
+                VALUES (%(alias)s, %(proc)s, %(updated)s, %(soft)s, '{}'::jsonb)
+                ON CONFLICT (patient_name) DO UPDATE SET
+                    procedure=EXCLUDED.procedure,
+                    last_updated=EXCLUDED.last_updated,
+                    soft_data=EXCLUDED.soft_data,
+                    version=patients.version + 1
+                WHERE %(ver)s::int IS NULL OR patients.version = %(ver)s::int
+                RETURNING patient_id
+            ), hist AS (
+                INSERT INTO dhp_history (patient_id, procedure, last_updated, soft_data)
+                SELECT patient_id, %(proc)s, %(updated)s, %(soft)s FROM ins
+            ), cutoff AS (
+                SELECT patient_id, history_id FROM dhp_history
+                WHERE patient_id = (SELECT patient_id FROM ins)
+                ORDER BY history_id DESC
+                OFFSET %(keep)s LIMIT 1
+            ), del AS (
+                DELETE FROM dhp_history h
+                USING cutoff c
+                WHERE h.patient_id = c.patient_id
+                  AND h.history_id <= c.history_id
+            )
+            SELECT patient_id FROM ins;
+        """
+        params['ver'] = expected_version
+        params['keep'] = self.history_limit - 1
+        if not self._execute_query(push_query, params, fetch='one', row_factory=tuple_row):
+            raise ConcurrencyConflict(
+                f"DHP for patient '{patient_name}' is no longer at version {expected_version}."
+            )
+        logger.debug("Updated DHP and created new DHP history snapshot for patient '%s'.", patient_name)
+
+        return patient_name
+
+    def push_dhp_many(self, dhp_list):
+        """
+        Pushes a batch of DHP documents on a single connection and transaction.
+
+        The upsert and history insert are sent with executemany, which psycopg
+        pipelines, and the history of every affected patient is trimmed with
+        one set-based DELETE.
+
+        Args:
+            dhp_list (list): DHP documents, each in the format accepted by push_dhp.
+
+        Returns:
+            list: The patient alias of each document, in input order.
+        """
+        params_list = [self._dhp_params(dhp_data) for dhp_data in dhp_list]
+        if not params_list:
+            return []
+        patient_names = list(dict.fromkeys(params['alias'] for params in params_list))
+
+        upsert_query = """
             INSERT INTO patients (patient_name, procedure, last_updated, soft_data, current_plan)
             VALUES (%(alias)s, %(proc)s, %(updated)s, %(soft)s, '{}'::jsonb)
             ON CONFLICT (patient_name) DO UPDATE SET
                 procedure=EXCLUDED.procedure,
                 last_updated=EXCLUDED.last_updated,
-                soft_data=EXCLUDED.soft_data;
+                soft_data=EXCLUDED.soft_data,
+                version=patients.version + 1;
         """
-        self._execute_query(update_query, params)
-        print(f"Updated DHP for patient '{patient_name}'.")
-
-        # Insert new DHP data into history
         history_query = """
-            INSERT INTO dhp_history (patient_name, procedure, last_updated, soft_data)
-            VALUES (%s, %s, %s, %s);
+            INSERT INTO dhp_history (patient_id, procedure, last_updated, soft_data)
+            SELECT patient_id, %(proc)s, %(updated)s, %(soft)s
+            FROM patients
+            WHERE patient_name = %(alias)s;
         """
-        self._execute_query(history_query, (params['alias'], params['proc'], params['updated'], params['soft']))
-        print(f"Created new DHP history snapshot for '{patient_name}'.")
-
-        # Trim DHP history
+        # One cutoff lookup per patient rather than per history row; patients
+        # still under the limit have no cutoff and drop out of the join
         trim_query = """
-            DELETE FROM dhp_history
-            WHERE history_id IN (
-                SELECT history_id FROM (
-                    SELECT history_id,
-                           ROW_NUMBER() OVER (ORDER BY history_id DESC) as rn
-                    FROM dhp_history
-                    WHERE patient_name = %s
-                ) as sub
-                WHERE rn > %s
-            )
+            DELETE FROM dhp_history h
+            USING patients p
+            CROSS JOIN LATERAL (
+                SELECT history_id FROM dhp_history
+                WHERE patient_id = p.patient_id
+                ORDER BY history_id DESC
+                OFFSET %s LIMIT 1
+            ) c
+            WHERE p.patient_name = ANY(%s)
+              AND h.patient_id = p.patient_id
+              AND h.history_id <= c.history_id;
         """
-        self._execute_query(trim_query, (patient_name, self.history_limit))
+        with self._transaction() as cursor:
+            cursor.executemany(upsert_query, params_list)
+            cursor.executemany(history_query, params_list)
+            cursor.execute(trim_query, (self.history_limit, patient_names))
+        logger.debug("Updated DHP and history snapshots for %d patient(s).", len(patient_names))
 
-        return patient_name
+        return [params['alias'] for params in params_list]
 
-    def push_plan_status(self, patient_name, plan_data):
+    def push_plan_status(self, patient_name, plan_data, expected_version=None):
         plan_snapshot = plan_data
 
-        history_query = """
-            INSERT INTO plan_history (patient_name, plan_snapshot)
-            VALUES (%s, %s);
-        """
-        self._execute_query(history_query, (patient_name, json.dumps(plan_snapshot)))
-        print(f"Created new plan history snapshot for '{patient_name}'.")
-
-        update_patient_query = """
-            UPDATE patients
-            SET current_plan = %s
-            WHERE patient_name = %s;
-        """
-        self._execute_query(update_patient_query, (json.dumps(plan_snapshot), patient_name))
-        
-        trim_query = """
-            DELETE FROM plan_history
-            WHERE history_id IN (
-                SELECT history_id FROM (
-                    SELECT history_id,
-                           ROW_NUMBER() OVER (ORDER BY history_id DESC) as rn
-                    FROM plan_history
-                    WHERE patient_name = %s
-                ) as sub
-                WHERE rn > %s
+        push_query = """
+            WITH upd AS (
+                UPDATE patients
+                SET current_plan = %(plan)s, version = version + 1
+                WHERE patient_name = %(alias)s
+                  AND (%(ver)s::int IS NULL OR version = %(ver)s::int)
+                RETURNING patient_id
+            ), hist AS (
+                INSERT INTO plan_history (patient_id, plan_snapshot)
+                SELECT patient_id, %(plan)s FROM upd
+            ), cutoff AS (
+                SELECT patient_id, history_id FROM plan_history
+                WHERE patient_id = (SELECT patient_id FROM upd)
+                ORDER BY history_id DESC
+                OFFSET %(keep)s LIMIT 1
+            ), del AS (
+                DELETE FROM plan_history h
+                USING cutoff c
+                WHERE h.patient_id = c.patient_id
+                  AND h.history_id <= c.history_id
             )
+            SELECT patient_id FROM upd;
         """
-        self._execute_query(trim_query, (patient_name, self.history_limit))
-
-        print(f"Processed and updated PlanStatus for patient '{patient_name}'.")
+        updated = self._execute_query(push_query, {
+            'alias': patient_name,
+            'plan': Jsonb(plan_snapshot),
+            'ver': expected_version,
+            'keep': self.history_limit - 1
+        }, fetch='one', row_factory=tuple_row)
+        if not updated:
+            if expected_version is None:
+                raise ValueError(f"Patient '{patient_name}' not found.")
+            raise ConcurrencyConflict(
+                f"Plan for patient '{patient_name}' is no longer at version {expected_version}."
+            )
+        logger.debug("Updated PlanStatus and created new plan history snapshot for patient '%s'.", patient_name)
 
-    def rollback_dhp(self, patient_name, steps=1):
+    def rollback_dhp(self, patient_name, steps=1, expected_version=None):
         if steps <= 0:
-            print("Rollback steps must be a positive number.")
+            logger.warning("Rollback steps must be a positive number.")
             return
 
-        history_query = """
-            SELECT history_id, procedure, last_updated, soft_data
-            FROM dhp_history
-            WHERE patient_name = %s
-            ORDER BY history_id DESC
-            LIMIT %s;
+        # Restore the patient from the snapshot `steps` entries back and drop the
+        # newer snapshots in one statement. Only the ids of the newer snapshots
+        # are collected; the payload is read for the target row alone. Without
+        # an expected_version the update is still guarded by the version seen in
+        # this statement's snapshot, so a concurrent push is reported instead of
+        # overwritten.
+        rollback_query = """
+            WITH cur AS (
+                SELECT patient_id, version FROM patients WHERE patient_name = %(alias)s
+            ), recent AS (
+                SELECT history_id
+                FROM dhp_history
+                WHERE patient_id = (SELECT patient_id FROM cur)
+                ORDER BY history_id DESC
+                LIMIT %(fetch)s
+            ), target AS (
+                SELECT procedure, last_updated, soft_data
+                FROM dhp_history
+                WHERE history_id = (
+                    SELECT history_id FROM recent
+                    ORDER BY history_id DESC
+                    OFFSET %(steps)s LIMIT 1
+                  )
+            ), upd AS (
+                UPDATE patients p
+                SET procedure = t.procedure, last_updated = t.last_updated, soft_data = t.soft_data, version = p.version + 1
+                FROM target t
+                WHERE p.patient_id = (SELECT patient_id FROM cur)
+                  AND p.version = COALESCE(%(ver)s::int, (SELECT version FROM cur))
+                RETURNING p.version
+            ), del AS (
+                DELETE FROM dhp_history
+                WHERE history_id IN (
+                    SELECT history_id FROM recent
+                    ORDER BY history_id DESC
+                    LIMIT %(steps)s
+                  )
+                  AND EXISTS (SELECT 1 FROM upd)
+            )
+            SELECT (SELECT count(*) FROM recent),
+                   COALESCE(%(ver)s::int, (SELECT version FROM cur)),
+                   (SELECT version FROM upd);
         """
-        history_records = self._execute_query(history_query, (patient_name, steps + 1), fetch='all')
-
-        if len(history_records) <= steps:
-            print(f"Cannot roll back DHP by {steps} step(s): Patient '{patient_name}' only has {len(history_records) -1} previous version(s).")
+        available, expected_version, new_version = self._execute_query(rollback_query, {
+            'alias': patient_name,
+            'steps': steps,
+            'fetch': steps + 1,
+            'ver': expected_version
+        }, fetch='one', row_factory=tuple_row)
+
+        if available <= steps:
+            logger.warning(
+                "Cannot roll back DHP by %d step(s): Patient '%s' only has %d previous version(s).",
+                steps, patient_name, available - 1
+            )
             return
 
-        target_record = history_records[steps]
-        records_to_delete = history_records[:steps]
-        ids_to_delete = [rec['history_id'] for rec in records_to_delete]
-
-        update_patient_query = """
-            UPDATE patients
-            SET procedure = %s, last_updated = %s, soft_data = %s
-            WHERE patient_name = %s;
-        """
-        self._execute_query(update_patient_query, (
-            target_record['procedure'],
-            target_record['last_updated'],
-            target_record['soft_data'],
-            patient_name
-        ))
-
-        delete_query = "DELETE FROM dhp_history WHERE history_id = ANY(%s::int[]);"
-        self._execute_query(delete_query, (ids_to_delete,))
+        if new_version is None:
+            raise ConcurrencyConflict(
+                f"DHP for patient '{patient_name}' is no longer at version {expected_version}."
+            )
 
-        print(f"Successfully rolled back DHP for patient '{patient_name}' by {steps} step(s).")
+        logger.debug("Successfully rolled back DHP for patient '%s' by %d step(s).", patient_name, steps)
 
-    def rollback_plan(self, patient_name, steps=1):
+    def rollback_plan(self, patient_name, steps=1, expected_version=None):
         if steps <= 0:
-            print("Rollback steps must be a positive number.")
+            logger.warning("Rollback steps must be a positive number.")
             return
 
-        history_query = """
-            SELECT history_id, plan_snapshot
-            FROM plan_history
-            WHERE patient_name = %s
-            ORDER BY history_id DESC
-            LIMIT %s;
+        rollback_query = """
+            WITH cur AS (
+                SELECT patient_id, version FROM patients WHERE patient_name = %(alias)s
+            ), recent AS (
+                SELECT history_id
+                FROM plan_history
+                WHERE patient_id = (SELECT patient_id FROM cur)
+                ORDER BY history_id DESC
+                LIMIT %(fetch)s
+            ), target AS (
+                SELECT plan_snapshot
+                FROM plan_history
+                WHERE history_id = (
+                    SELECT history_id FROM recent
+                    ORDER BY history_id DESC
+                    OFFSET %(steps)s LIMIT 1
+                  )
+            ), upd AS (
+                UPDATE patients p
+                SET current_plan = t.plan_snapshot, version = p.version + 1
+                FROM target t
+                WHERE p.patient_id = (SELECT patient_id FROM cur)
+                  AND p.version = COALESCE(%(ver)s::int, (SELECT version FROM cur))
+                RETURNING p.version
+            ), del AS (
+                DELETE FROM plan_history
+                WHERE history_id IN (
+                    SELECT history_id FROM recent
+                    ORDER BY history_id DESC
+                    LIMIT %(steps)s
+                  )
+                  AND EXISTS (SELECT 1 FROM upd)
+            )
+            SELECT (SELECT count(*) FROM recent),
+                   COALESCE(%(ver)s::int, (SELECT version FROM cur)),
+                   (SELECT version FROM upd);
         """
-        history_records = self._execute_query(history_query, (patient_name, steps + 1), fetch='all')
-
-        if len(history_records) <= steps:
-            print(f"Cannot roll back plan by {steps} step(s): Patient '{patient_name}' only has {len(history_records) -1} previous version(s).")
+        available, expected_version, new_version = self._execute_query(rollback_query, {
+            'alias': patient_name,
+            'steps': steps,
+            'fetch': steps + 1,
+            'ver': expected_version
+        }, fetch='one', row_factory=tuple_row)
+
+        if available <= steps:
+            logger.warning(
+                "Cannot roll back plan by %d step(s): Patient '%s' only has %d previous version(s).",
+                steps, patient_name, available - 1
+            )
             return
 
-        target_record = history_records[steps]
-        records_to_delete = history_records[:steps]
-        ids_to_delete = [rec['history_id'] for rec in records_to_delete]
-
-        update_patient_query = """
-            UPDATE patients
-            SET current_plan = %s
-            WHERE patient_name = %s;
-        """
-        self._execute_query(update_patient_query, (
-            json.dumps(target_record['plan_snapshot']),
-            patient_name
-        ))
-
-        delete_query = "DELETE FROM plan_history WHERE history_id = ANY(%s::int[]);"
-        self._execute_query(delete_query, (ids_to_delete,))
+        if new_version is None:
+            raise ConcurrencyConflict(
+                f"Plan for patient '{patient_name}' is no longer at version {expected_version}."
+            )
 
-        print(f"Successfully rolled back plan for patient '{patient_name}' by {steps} step(s).")
+        logger.debug("Successfully rolled back plan for patient '%s' by %d step(s).", patient_name, steps)
 
-    def get_dhp(self, patient_name):
+    def get_dhp(self, patient_name, with_version=False):
         dhp_data = self._execute_query(
-            "SELECT patient_name, procedure, last_updated, soft_data FROM patients WHERE patient_name = %s",
+            "SELECT patient_name, procedure, last_updated, soft_data, version FROM patients WHERE patient_name = %s",
             (patient_name,),
-            fetch='one'
+            fetch='one',
+            row_factory=tuple_row
         )
 
         if not dhp_data:
-            return None
+            return (None, None) if with_version else None
 
+        last_updated = dhp_data[2].isoformat() if dhp_data[2] else None
         output_data = {
             "hard": {
-                "Patient Alias": dhp_data['patient_name'],
-                "Patient's Procedure Performed or Non-Surgical Pathology": dhp_data['procedure'],
-                "Time of most recent update": dhp_data['last_updated']
+                "Patient Alias": dhp_data[0],
+                "Patient's Procedure Performed or Non-Surgical Pathology": dhp_data[1],
+                "Time of most recent update": last_updated
             },
-            "soft": dhp_data['soft_data']
+            "soft": dhp_data[3]
         }
+        if with_version:
+            return output_data, dhp_data[4]
         return output_data
 
-    def get_plan_status(self, patient_name):
+    def get_plan_status(self, patient_name, with_version=False):
         patient_data = self._execute_query(
-            "SELECT current_plan FROM patients WHERE patient_name = %s",
+            "SELECT current_plan, version FROM patients WHERE patient_name = %s",
             (patient_name,),
-            fetch='one'
+            fetch='one',
+            row_factory=tuple_row
         )
 
-        if not patient_data or not patient_data['current_plan']:
-            return None
-        
-        return patient_data['current_plan']
+        if not patient_data:
+            return (None, None) if with_version else None
+
+        current_plan, version = patient_data
+        current_plan = current_plan or None
+        if with_version:
+            return current_plan, version
+        return current_plan
+
+    def get_plan_status_raw(self, patient_name, pretty=False):
+        """
+        Returns the current plan as JSON text rendered by the server, without
+        decoding it into Python objects. Returns None if the patient is not
+        found or has no plan.
+
+        Args:
+            patient_name (str): The patient alias.
+            pretty (bool, optional): Render indented JSON with jsonb_pretty
+                                     instead of the compact form. Defaults to False.
+        """
+        if pretty:
+            query = "SELECT jsonb_pretty(NULLIF(current_plan, '{}'::jsonb)) FROM patients WHERE patient_name = %s"
+        else:
+            query = "SELECT NULLIF(current_plan, '{}'::jsonb)::text FROM patients WHERE patient_name = %s"
+        patient_data = self._execute_query(query, (patient_name,), fetch='one', row_factory=tuple_row)
+        return patient_data[0] if patient_data else None
 
     def export_dhp_to_json(self, patient_name, file_path):
         dhp_content = self.get_dhp(patient_name)
 
         if not dhp_content:
-            print(f"Could not export DHP: Patient '{patient_name}' not found.")
+            logger.warning("Could not export DHP: Patient '%s' not found.", patient_name)
             return
 
-        with open(file_path, 'w') as f:
-            json.dump(dhp_content, f, indent=2)
-        print(f"Successfully exported DHP for '{patient_name}' to '{file_path}'.")
+        with open(file_path, 'wb') as f:
+            f.write(_json_dumps(dhp_content, option=orjson.OPT_INDENT_2))
+        logger.debug("Successfully exported DHP for '%s' to '%s'.", patient_name, file_path)
 
     def export_plan_status_to_json(self, patient_name, file_path):
-        plan_status_output = self.get_plan_status(patient_name)
+        plan_status_output = self.get_plan_status_raw(patient_name, pretty=True)
 
         if not plan_status_output:
-            print(f"Could not export plan status: Patient '{patient_name}' not found or has no plan.")
+            logger.warning("Could not export plan status: Patient '%s' not found or has no plan.", patient_name)
             return
 
-        with open(file_path, 'w') as f:
-            json.dump(plan_status_output, f, indent=2)
-        print(f"Successfully exported PlanStatus for '{patient_name}' to '{file_path}'.")
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(plan_status_output)
+        logger.debug("Successfully exported PlanStatus for '%s' to '%s'.", patient_name, file_path)
 
     def close(self):
-        """Closes the database connection."""
-        if self.conn and not self.conn.closed:
-            self.conn.close()
\ No newline at end of file
+        """Closes the database connection pool."""
+        if not self.pool.closed:
+            self.pool.close()
\ No newline at end of file